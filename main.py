@@ -1,5 +1,5 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl
 from fastapi.responses import StreamingResponse
 import os
 import asyncio
@@ -8,7 +8,19 @@ import logging
 from dotenv import load_dotenv
 import psutil
 import fitz
+from PIL import Image
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
 import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing import shared_memory
+import io
 from io import BytesIO
 
 app = FastAPI()
@@ -20,37 +32,232 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 
+DEFAULT_DPI = 100
+MIN_DPI = 36
+MAX_DPI = 200
+
+
 class PDFUrl(BaseModel):
     url: HttpUrl
+    dpi: int = Field(
+        DEFAULT_DPI, ge=MIN_DPI, le=MAX_DPI,
+        description="Rendering resolution. Time and memory grow with the square of the DPI, "
+                    "so pick the lowest value that is sufficient (72-100 is enough for previews and OCR)."
+    )
+
+
+# Set RESOURCE_LOG=0 to turn resource usage logging off entirely
+RESOURCE_LOG = os.getenv("RESOURCE_LOG", "1") == "1"
+_PROC = psutil.Process(os.getpid())
 
 
 def log_resource_usage(stage):
-    process = psutil.Process(os.getpid())
-    mem_info = process.memory_info()
-    cpu_percent = process.cpu_percent(interval=None)
+    if not RESOURCE_LOG or not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    mem_info = _PROC.memory_info()
+    cpu_percent = _PROC.cpu_percent(interval=None)
     logging.info(f"{stage} - Memory Usage: {mem_info.rss / (1024 * 1024):.2f} MB, CPU Usage: {cpu_percent}%")
 
 
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=60)
+# The preflight HEAD is only an optimisation, so an origin that is slow to
+# answer it falls through to the GET instead of holding up the request
+HEAD_TIMEOUT = aiohttp.ClientTimeout(total=5)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_PDF_SIZE = 100 * 1024 * 1024  # 100 MB
+
+
+# On-disk cache of finished ZIPs. Entries are keyed on URL + DPI plus the
+# ETag/Last-Modified validator when the origin sends one; entries without a
+# validator expire after CACHE_TTL seconds. Set CACHE_MAX_BYTES=0 to disable.
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdf2png-cache"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))  # 1 GB
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+CACHE_READ_CHUNK_SIZE = 1024 * 1024
+
+
+@app.on_event("startup")
+async def startup():
+    global render_pool
+    # One long-lived session so connections (and TLS sessions) to the same
+    # hosts are pooled across requests.
+    app.state.session = aiohttp.ClientSession(
+        headers={'User-Agent': 'Mozilla/5.0'},
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=60),
+    )
+    if CACHE_MAX_BYTES > 0:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+    # Created before the render workers start, so they share the blocks'
+    # resource tracker
+    app.state.shm_slots = SharedSlotPool(get_shm_slot_count(), SHM_SLOT_SIZE)
+    render_pool = new_render_pool()
+
+
+async def head_pdf(url: str):
+    # Preflight HEAD request that rejects non-PDF and oversized URLs before
+    # any of the body is downloaded. Returns the response headers, or None if
+    # the origin doesn't answer HEAD with a 200 (e.g. 405, or presigned URLs
+    # that are only valid for GET); download_pdf then does the same checks.
+    try:
+        async with app.state.session.head(url, allow_redirects=True, timeout=HEAD_TIMEOUT) as response:
+            if response.status != 200:
+                logging.info(f"HEAD status: {response.status}")
+                return None
+            content_type = response.headers.get('Content-Type', '')
+            if 'pdf' not in content_type.lower():
+                raise HTTPException(status_code=400,
+                                    detail=f"URL does not point to a PDF file. Content-Type: {content_type}")
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > MAX_PDF_SIZE:
+                raise HTTPException(status_code=400, detail="PDF file is too large.")
+            return response.headers
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.info(f"HEAD request failed: {e!r}")
+    return None
+
+
+def get_cache_entry(url: str, dpi: int, headers):
+    # Returns (path, expires) for the cache file of this URL and DPI
+    validator = None
+    if headers is not None:
+        validator = headers.get('ETag') or headers.get('Last-Modified')
+    key = hashlib.sha256(f"{url}\n{dpi}\n{validator or ''}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.zip"), validator is None
+
+
+def open_cached_zip(path: str, expires: bool):
+    try:
+        cached_file = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    stat = os.fstat(cached_file.fileno())
+    now = time.time()
+    if expires and now - stat.st_mtime > CACHE_TTL:
+        cached_file.close()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None
+    # mtime records when the entry was written (for the TTL), atime when it
+    # was last served (for LRU eviction). The open file can still be served if
+    # another worker evicted the entry in the meantime.
+    try:
+        os.utime(path, (now, stat.st_mtime))
+    except FileNotFoundError:
+        pass
+    return cached_file
+
+
+def iter_cached_zip(cached_file):
+    with cached_file:
+        while chunk := cached_file.read(CACHE_READ_CHUNK_SIZE):
+            yield chunk
+
+
+def evict_cache():
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(".zip"):
+            stat = entry.stat()
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def _open_cache_tmp():
+    try:
+        return tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False)
+    except OSError as e:
+        logging.warning(f"Could not create cache file: {e}")
+        return None
+
+
+def _discard_cache_tmp(tmp):
+    try:
+        tmp.close()
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+    except OSError as e:
+        logging.warning(f"Could not remove cache file: {e}")
+
+
+def _store_cached_zip(tmp, path: str):
+    # Runs after the last chunk has been sent, so failures here only cost the
+    # cache entry, never the response (e.g. another uvicorn worker evicting
+    # the same files)
+    try:
+        tmp.close()
+        os.replace(tmp.name, path)
+    except OSError as e:
+        logging.warning(f"Could not store cache entry: {e}")
+        _discard_cache_tmp(tmp)
+        return
+    try:
+        evict_cache()
+    except OSError as e:
+        logging.warning(f"Cache eviction failed: {e}")
+
+
+async def cache_zip_stream(path: str, chunks):
+    # Passes the ZIP through to the client while writing it to a temp file
+    # that only becomes a cache entry once the archive is complete. All file
+    # I/O runs in threads to keep the event loop free.
+    tmp = await asyncio.to_thread(_open_cache_tmp)
+    try:
+        async for chunk in chunks:
+            if tmp is not None:
+                try:
+                    await asyncio.to_thread(tmp.write, chunk)
+                except OSError as e:
+                    logging.warning(f"Could not write cache file: {e}")
+                    await asyncio.to_thread(_discard_cache_tmp, tmp)
+                    tmp = None
+            yield chunk
+        if tmp is not None:
+            await asyncio.to_thread(_store_cached_zip, tmp, path)
+            tmp = None
+    finally:
+        if tmp is not None:
+            await asyncio.to_thread(_discard_cache_tmp, tmp)
+        await chunks.aclose()
+
+
 async def download_pdf(url: str) -> bytes:
     try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(url, allow_redirects=True) as response:
-                logging.info(f"Response status: {response.status}")
-                logging.info(f"Response headers: {response.headers}")
-                if response.status != 200:
-                    raise HTTPException(status_code=400,
-                                        detail=f"Failed to download PDF. Status code: {response.status}")
-                content_type = response.headers.get('Content-Type', '')
-                logging.info(f"Content-Type: {content_type}")
-                if 'pdf' not in content_type.lower():
-                    raise HTTPException(status_code=400,
-                                        detail=f"URL does not point to a PDF file. Content-Type: {content_type}")
-                pdf_bytes = await response.read()
-                MAX_PDF_SIZE = 100 * 1024 * 1024  # 100 MB
-                if len(pdf_bytes) > MAX_PDF_SIZE:
+        session = app.state.session
+        async with session.get(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            logging.info(f"Response status: {response.status}")
+            logging.info(f"Response headers: {response.headers}")
+            if response.status != 200:
+                raise HTTPException(status_code=400,
+                                    detail=f"Failed to download PDF. Status code: {response.status}")
+            content_type = response.headers.get('Content-Type', '')
+            logging.info(f"Content-Type: {content_type}")
+            if 'pdf' not in content_type.lower():
+                raise HTTPException(status_code=400,
+                                    detail=f"URL does not point to a PDF file. Content-Type: {content_type}")
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > MAX_PDF_SIZE:
+                raise HTTPException(status_code=400, detail="PDF file is too large.")
+            # Read the body chunk by chunk so oversized files are rejected
+            # as soon as they cross the limit instead of after a full download
+            pdf_buffer = bytearray()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                pdf_buffer += chunk
+                if len(pdf_buffer) > MAX_PDF_SIZE:
+                    response.close()
                     raise HTTPException(status_code=400, detail="PDF file is too large.")
-                return pdf_bytes
+            return bytes(pdf_buffer)
+    except HTTPException:
+        raise
     except aiohttp.ClientError as e:
         logging.error(f"Client error: {e}", exc_info=True)
         raise HTTPException(status_code=400, detail="Client error occurred while downloading PDF.")
@@ -59,63 +266,439 @@ async def download_pdf(url: str) -> bytes:
         raise HTTPException(status_code=500, detail="Unexpected error occurred.")
 
 
-async def convert_pdf_to_images(pdf_bytes: bytes):
+# Worker pool for page rendering. PyMuPDF is not thread-safe, so pages are
+# rendered in separate processes. The pool is created once at startup and
+# reused so workers are not started for every request.
+# Workers come from a fork server instead of being forked from this process:
+# the pool starts them on first use, when asyncio.to_thread and aiohttp have
+# already started threads, and forking a multi-threaded process can leave the
+# child with locks that are never released. The same goes for a replacement
+# pool started mid-traffic. The fork server preloads this module so new
+# workers don't import PyMuPDF and Pillow again; the pool itself is created
+# in startup() so that import has no side effects.
+RENDER_WORKERS = os.cpu_count() or 1
+RENDER_MP_CONTEXT = multiprocessing.get_context("forkserver")
+RENDER_MP_CONTEXT.set_forkserver_preload([__name__])
+render_pool = None
+SEGMENT_PAGES = 8  # Pages rendered per worker task
+MAX_PENDING_SEGMENTS = 2 * RENDER_WORKERS  # Segments in flight per request
+PNG_COMPRESS_LEVEL = 1
+# Shared memory that workers write encoded pages into, so PNG bytes aren't
+# pickled back through the pool's result pipe. The pool takes at most
+# SHM_POOL_BYTES and a quarter of the free space in /dev/shm, leaving the
+# rest for temp PDFs and other processes; pages that are bigger than a slot
+# or that find no free slot are returned the regular way.
+SHM_SLOT_SIZE = 2 * 1024 * 1024
+SHM_POOL_BYTES = int(os.getenv("SHM_POOL_BYTES", str(48 * 1024 * 1024)))
+SHM_POOL_FRACTION = 0.25
+EXTRACT_DPI_TOLERANCE = 1.1  # Embedded scans up to 10% above the requested DPI are shipped as-is
+PDF_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+_RENDER_MATRICES = {}
+_attached_slots = {}  # Worker side: shared memory blocks by name
+
+
+class SharedSlotPool:
+    """Fixed set of shared memory blocks handed out to render segments.
+
+    Blocks are created once in the main process before the workers start and
+    reused for every request.
+    """
+
+    def __init__(self, slot_count: int, slot_size: int):
+        self._blocks = {}
+        for _ in range(slot_count):
+            try:
+                block = shared_memory.SharedMemory(create=True, size=slot_size)
+            except OSError as e:
+                logging.warning(f"Could not create shared memory slot: {e}")
+                break
+            try:
+                self._reserve(block)
+            except OSError as e:
+                logging.warning(f"Could not reserve shared memory slot: {e}")
+                block.close()
+                block.unlink()
+                break
+            self._blocks[block.name] = block
+        logging.info(f"Using {len(self._blocks)} shared memory slots for rendered pages.")
+        self._free = list(self._blocks)
+        # release() is also called from the executor's callback thread
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _reserve(block):
+        # Allocate the block's pages up front: when /dev/shm is full this
+        # fails with ENOSPC here, instead of a SIGBUS later when a page of the
+        # block is first written
+        if PDF_TMP_DIR is None:
+            return
+        fd = os.open(os.path.join(PDF_TMP_DIR, block.name), os.O_RDWR)
+        try:
+            os.posix_fallocate(fd, 0, block.size)
+        finally:
+            os.close(fd)
+
+    def take(self, count: int) -> list:
+        # Never blocks: returns fewer slots (possibly none) when the pool is
+        # running low
+        with self._lock:
+            taken = self._free[-count:] if count else []
+            del self._free[len(self._free) - len(taken):]
+        return taken
+
+    def release(self, names: list):
+        with self._lock:
+            self._free.extend(names)
+
+    def view(self, name: str, length: int) -> memoryview:
+        return self._blocks[name].buf[:length]
+
+    def close(self):
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self._blocks.clear()
+        self._free.clear()
+
+
+def get_shm_slot_count() -> int:
+    pool_bytes = SHM_POOL_BYTES
+    if PDF_TMP_DIR is not None:
+        pool_bytes = min(pool_bytes, int(shutil.disk_usage(PDF_TMP_DIR).free * SHM_POOL_FRACTION))
+    return pool_bytes // SHM_SLOT_SIZE
+
+
+def new_render_pool():
+    return ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=RENDER_MP_CONTEXT)
+
+
+def replace_broken_render_pool(broken_pool):
+    # A worker that dies (OOM kill, MuPDF crash) breaks the whole pool, so
+    # start a fresh one for the following requests
+    global render_pool
+    if render_pool is broken_pool:
+        logging.error("Render pool is broken, starting a new one.")
+        render_pool = new_render_pool()
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_render_matrix(dpi: int):
+    # Computed once per DPI rather than per page by get_pixmap(dpi=...)
+    matrix = _RENDER_MATRICES.get(dpi)
+    if matrix is None:
+        matrix = _RENDER_MATRICES[dpi] = fitz.Matrix(dpi / 72.0, dpi / 72.0)
+    return matrix
+
+
+def _save_png(image) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def _encode_png(pix) -> bytes:
+    # Encode straight from the pixmap's sample buffer with Pillow. A low zlib
+    # level keeps most of the size savings at a fraction of the CPU cost of
+    # MuPDF's default-level PNG writer.
+    image = Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1)
+    # Text-heavy pages rarely use more than 256 colours and compress much
+    # better with one byte per pixel. All-gray pages become 8-bit grayscale,
+    # which is lossless by construction and cheap. Other low-colour pages get
+    # a palette of the N most frequent colours, where N is the number of
+    # colours, so every colour is kept; the round trip is still checked.
+    colors = image.getcolors(256)
+    if colors is not None:
+        if all(r == g == b for _, (r, g, b) in colors):
+            return _save_png(image.convert("L"))
+        palette_image = image.quantize(colors=len(colors), method=Image.Quantize.MAXCOVERAGE,
+                                       dither=Image.Dither.NONE)
+        if palette_image.convert("RGB").tobytes() == image.tobytes():
+            return _save_png(palette_image)
+    return _save_png(image)
+
+
+def write_temp_pdf(pdf_bytes: bytes) -> str:
+    # Prefer tmpfs so the workers read the PDF from memory. Falls back to the
+    # regular temp dir when /dev/shm is missing or too small (Docker's default
+    # is 64 MB).
+    if PDF_TMP_DIR is not None:
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=PDF_TMP_DIR, suffix=".pdf", delete=False) as tmp:
+                tmp_path = tmp.name
+                tmp.write(pdf_bytes)
+            return tmp_path
+        except OSError as e:
+            logging.info(f"Could not write PDF to {PDF_TMP_DIR}, using the default temp dir: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(pdf_bytes)
+        return tmp.name
+
+
+def _count_pages(filename: str) -> int:
+    # Runs in a worker process like the rendering itself, since PyMuPDF isn't
+    # safe to call from several threads of the main process at once
+    with fitz.open(filename) as doc:
+        return doc.page_count
+
+
+def _extract_page_image(doc, page, dpi: int):
+    # Scanned pages are usually a single JPEG/PNG covering the whole page.
+    # For those the embedded image is returned as (ext, image_bytes) so it can
+    # be shipped as-is instead of being rasterized and re-encoded. Returns
+    # None when the page has to be rendered.
+    if page.rotation or page.first_annot is not None:
+        return None
+    images = page.get_images(full=True)
+    if len(images) != 1 or images[0][1]:  # Exactly one image, without a soft mask
+        return None
+    xref, _, width, height = images[0][:4]
+    # Only when the scan isn't sharper than requested: a 600 DPI scan asked
+    # for at 100 DPI is rendered down instead of shipped at full size
+    max_dpi = dpi * EXTRACT_DPI_TOLERANCE
+    if width / page.rect.width * 72 > max_dpi or height / page.rect.height * 72 > max_dpi:
+        return None
+    image_rects = page.get_image_rects(xref, transform=True)
+    if len(image_rects) != 1:
+        return None
+    image_rect, transform = image_rects[0]
+    # Upright (not rotated, sheared or mirrored) and covering the page to 1%
+    if transform.b or transform.c or transform.a <= 0 or transform.d <= 0:
+        return None
+    page_area = page.rect.get_area()
+    if (image_rect & page.rect).get_area() < 0.99 * page_area or image_rect.get_area() > 1.01 * page_area:
+        return None
+    # Anything drawn on top of the image (visible text, vector graphics) would
+    # be lost; invisible OCR text layers are fine
+    if page.get_drawings() or any(span["type"] != 3 for span in page.get_texttrace()):
+        return None
+    image = doc.extract_image(xref)
+    if not image or image["ext"] not in ("png", "jpeg") or image["colorspace"] not in (1, 3):
+        return None
+    return image["ext"], image["image"]
+
+
+def _write_to_slot(slot_name: str, data: bytes):
+    block = _attached_slots.get(slot_name)
+    if block is None:
+        block = _attached_slots[slot_name] = shared_memory.SharedMemory(name=slot_name)
+    block.buf[:len(data)] = data
+
+
+def _render_segment(filename: str, start: int, end: int, dpi: int, slot_names: list):
+    # Runs in a worker process: Document objects can't be pickled, so each
+    # worker opens the PDF from the temp file and renders its own page range.
+    # Returns (page_num, ext, slot_name, image) tuples: image is the length
+    # written to the slot, or the image bytes themselves when slot_name is None.
+    image_bytes_list = []
+    matrix = get_render_matrix(dpi)
+    with fitz.open(filename) as doc:
+        for page_num in range(start, end):
+            page = doc.load_page(page_num)
+            extracted = _extract_page_image(doc, page, dpi)
+            if extracted is not None:
+                ext, image_bytes = extracted
+            else:
+                pix = page.get_pixmap(matrix=matrix, alpha=False)
+                ext, image_bytes = "png", _encode_png(pix)
+            slot_index = page_num - start
+            if slot_index < len(slot_names) and len(image_bytes) <= SHM_SLOT_SIZE:
+                _write_to_slot(slot_names[slot_index], image_bytes)
+                image_bytes_list.append((page_num + 1, ext, slot_names[slot_index], len(image_bytes)))
+            else:
+                image_bytes_list.append((page_num + 1, ext, None, image_bytes))  # Include page number
+    return image_bytes_list
+
+
+async def convert_pdf_to_images(pdf_bytes: bytes, dpi: int = DEFAULT_DPI):
+    # Async generator: yields (page_num, ext, image_bytes) in page order as soon as
+    # the segment containing each page has been rendered. image_bytes may be a
+    # view into shared memory that is only valid until the next page is
+    # requested.
+    pool = render_pool
     try:
         log_resource_usage("Before Conversion")
-        image_bytes_list = []
         MAX_PAGE_COUNT = 5000  # Limit the number of pages to process
-        DPI = 200  # Set DPI to reduce resource usage
-        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-            page_count = doc.page_count
+        pdf_path = await asyncio.to_thread(write_temp_pdf, pdf_bytes)
+        del pdf_bytes  # Workers read the temp file; don't hold the bytes while streaming
+        shm_slots = app.state.shm_slots
+        pending = deque()
+        try:
+            page_count = await asyncio.wrap_future(pool.submit(_count_pages, pdf_path))
             logging.info(f"PDF has {page_count} pages.")
             if page_count > MAX_PAGE_COUNT:
                 raise HTTPException(
                     status_code=400,
                     detail=f"PDF has too many pages ({page_count}). Maximum allowed is {MAX_PAGE_COUNT}."
                 )
-            for page_num in range(min(page_count, MAX_PAGE_COUNT)):
-                page = doc.load_page(page_num)
-                pix = page.get_pixmap(dpi=DPI)
-                image_bytes = pix.tobytes("png")
-                image_bytes_list.append((page_num + 1, image_bytes))  # Include page number
+            # Submit short page segments as separate tasks so idle workers
+            # pick up the next segment instead of waiting on one slow range.
+            # Only a bounded number are in flight so rendered pages don't pile
+            # up in memory faster than the client reads them.
+            segment_starts = iter(range(0, page_count, SEGMENT_PAGES))
+
+            def submit_next_segment():
+                start = next(segment_starts, None)
+                if start is not None:
+                    end = min(start + SEGMENT_PAGES, page_count)
+                    slot_names = shm_slots.take(end - start)
+                    future = pool.submit(_render_segment, pdf_path, start, end, dpi, slot_names)
+                    pending.append((future, slot_names))
+
+            for _ in range(MAX_PENDING_SEGMENTS):
+                submit_next_segment()
+            while pending:
+                future, slot_names = pending[0]
+                segment = await asyncio.wrap_future(future)
+                pending.popleft()
+                submit_next_segment()
+                try:
+                    for page_num, ext, slot_name, image_bytes in segment:
+                        if slot_name is None:
+                            yield page_num, ext, image_bytes
+                            continue
+                        image_view = shm_slots.view(slot_name, image_bytes)
+                        try:
+                            yield page_num, ext, image_view
+                        finally:
+                            image_view.release()
+                finally:
+                    shm_slots.release(slot_names)
+        finally:
+            # A segment that is already running still writes into its slots,
+            # so those are only released once it has finished
+            for future, slot_names in pending:
+                if future.cancel():
+                    shm_slots.release(slot_names)
+                else:
+                    future.add_done_callback(lambda _, names=slot_names: shm_slots.release(names))
+            os.unlink(pdf_path)
         log_resource_usage("After Conversion")
-        return image_bytes_list
+    except HTTPException:
+        raise
+    except BrokenProcessPool as e:
+        logging.error(f"Render worker died while converting PDF: {e}", exc_info=True)
+        replace_broken_render_pool(pool)
+        raise HTTPException(status_code=500, detail="Error converting PDF to images.")
     except Exception as e:
         logging.error(f"Error converting PDF to images: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Error converting PDF to images.")
-        
-# Create a background task that delays the memory cleanup
-async def delayed_cleanup(zip_buffer):
-    # Sleep for 10 minutes (600 seconds)
-    await asyncio.sleep(600)
-    zip_buffer.close()  # Close the BytesIO object
-    print("ZIP buffer closed and memory released after 10 minutes.")
+
+
+class ZipStreamWriter:
+    """Write-only file object that buffers ZipFile output until it is taken.
+
+    It reports its position and lets ZipFile seek back within the output that
+    hasn't been taken yet. That is all ZipFile needs to rewrite each local
+    header with the real CRC and sizes once the entry's data is written, so
+    entries don't use data descriptors, which streaming readers like Java's
+    ZipInputStream reject for stored entries. Output is taken after every
+    entry, so the header being rewritten is always still buffered.
+
+    Buffers are kept as ZipFile passed them, without copying. A page's image
+    may be a view of a shared memory slot, which stays valid until the next
+    page is requested, so taken chunks must be used before then.
+    """
+
+    def __init__(self):
+        self._chunks = []  # (offset, data) written since the last take()
+        self._position = 0
+        self._end = 0
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("only absolute seeks are supported")
+        self._position = offset
+        return offset
+
+    def write(self, data) -> int:
+        if self._position == self._end:
+            self._chunks.append((self._position, data))
+            self._end += len(data)
+        else:
+            # ZipFile rewriting a local header it wrote earlier
+            for index, (offset, chunk) in enumerate(self._chunks):
+                if offset == self._position and len(chunk) == len(data):
+                    self._chunks[index] = (offset, data)
+                    break
+            else:
+                raise io.UnsupportedOperation("can only overwrite output that hasn't been taken")
+        self._position += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> list:
+        chunks = [chunk for _, chunk in self._chunks]
+        self._chunks.clear()
+        return chunks
+
+
+async def stream_zip(first_page, pages):
+    sink = ZipStreamWriter()
+    try:
+        # PNGs and JPEGs are already compressed, so store them as-is
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zip_file:
+            page_num, ext, image_bytes = first_page
+            zip_file.writestr(f'page_{page_num}.{ext}', image_bytes)
+            for chunk in sink.take():
+                yield chunk
+            async for page_num, ext, image_bytes in pages:
+                # Save each image in the ZIP with a filename like 'page_1.png', 'page_2.jpeg', etc.
+                zip_file.writestr(f'page_{page_num}.{ext}', image_bytes)
+                for chunk in sink.take():
+                    yield chunk
+        # Central directory, written when the ZipFile is closed
+        for chunk in sink.take():
+            yield chunk
+    finally:
+        await pages.aclose()
+
+
+ZIP_RESPONSE_HEADERS = {"Content-Disposition": "attachment; filename=converted_pages.zip"}
+
 
 @app.post("/convert-pdf")
 async def convert_pdf(pdf: PDFUrl):
-    pdf_bytes = await download_pdf(str(pdf.url))
-    image_bytes_list = await convert_pdf_to_images(pdf_bytes)
+    url = str(pdf.url)
+    head_headers = await head_pdf(url)
+    cache_path = None
+    if CACHE_MAX_BYTES > 0:
+        cache_path, expires = get_cache_entry(url, pdf.dpi, head_headers)
+        cached_file = await asyncio.to_thread(open_cached_zip, cache_path, expires)
+        if cached_file is not None:
+            logging.info(f"Serving cached ZIP for {url}")
+            return StreamingResponse(iter_cached_zip(cached_file), media_type="application/zip",
+                                     headers=ZIP_RESPONSE_HEADERS)
+
+    pdf_bytes = await download_pdf(url)
+    pages = convert_pdf_to_images(pdf_bytes, pdf.dpi)
 
-    if not image_bytes_list:
+    # Wait for the first page before responding so download and conversion
+    # errors are still reported with a proper status code
+    try:
+        first_page = await anext(pages)
+    except StopAsyncIteration:
         raise HTTPException(status_code=500, detail="No images were generated.")
 
-    # Create ZIP file in memory
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for page_num, image_bytes in image_bytes_list:
-            # Save each image in the ZIP with a filename like 'page_1.png', 'page_2.png', etc.
-            zip_file.writestr(f'page_{page_num}.png', image_bytes)
-
-    # Make sure to seek to the start of the buffer before sending it
-    zip_buffer.seek(0)
-    
-    # Start the delayed cleanup task in the background
-    asyncio.create_task(delayed_cleanup(zip_buffer))
-    
-    # Return the ZIP file as a streaming response
-    return StreamingResponse(zip_buffer, media_type="application/zip", headers={
-        "Content-Disposition": "attachment; filename=converted_pages.zip"
-    })
+    # Stream the ZIP as pages are rendered instead of building it in memory
+    zip_stream = stream_zip(first_page, pages)
+    if cache_path is not None:
+        zip_stream = cache_zip_stream(cache_path, zip_stream)
+    return StreamingResponse(zip_stream, media_type="application/zip", headers=ZIP_RESPONSE_HEADERS)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.session.close()
+    render_pool.shutdown(wait=True, cancel_futures=True)
+    app.state.shm_slots.close()
 
 
 @app.get("/health")